@@ -0,0 +1,6 @@
+from persephone_client.build_helpers import (
+    CircleCIBuildHelper, JenkinsBuildHelper, PersephoneBuildHelper,
+)
+from persephone_client.client import (
+    AsyncPersephoneClient, PersephoneClient, PersephoneException,
+)
@@ -1,6 +1,14 @@
 import os
+import pathlib
+import random
 
-from persephone_client.client import PersephoneException, PersephoneClient
+from persephone_client.client import (
+    ACCEPT_JSON_HEADERS, POOL_MAXSIZE, AsyncPersephoneClient, PersephoneClient, PersephoneException,
+    _dumps, _loads, _open_image,
+)
+
+DEFAULT_UPLOAD_CONCURRENCY = 8
+UPLOAD_MAX_RETRIES = 3
 
 
 class PersephoneBuildHelper:
@@ -17,6 +25,7 @@ class PersephoneBuildHelper:
                  original_build_url=None,
                  pull_request_id=None,
                  build_id=None,
+                 http2=False,
                  ):
         """
         Creates an instance of the PersephoneClient
@@ -36,8 +45,9 @@ class PersephoneBuildHelper:
         :param pull_request_id: The pull request ID in GitHub for this build. (optional)
         :param build_id: The Persephone build ID. Important: only specify this if the build is
         already created in another process and you only want to upload screenshots.
+        :param http2: Talk to Persephone over HTTP/2 using httpx. Requires httpx[http2]. (optional)
         """
-        self.client = PersephoneClient(root_endpoint, username, password)
+        self.client = PersephoneClient(root_endpoint, username, password, http2=http2)
         self.project_id = project_id
         self.commit_hash = commit_hash
         self.branch_name = branch_name
@@ -46,6 +56,17 @@ class PersephoneBuildHelper:
         self.pull_request_id = pull_request_id
         self.build_id = build_id
 
+    @property
+    def build_id(self):
+        return self._build_id
+
+    @build_id.setter
+    def build_id(self, build_id):
+        self._build_id = build_id
+        # Resolved once per build, as every screenshot upload goes to the same endpoint
+        self._screenshots_url = (
+            self.client._build(self.project_id, build_id).screenshots if build_id else None)
+
     def create_build(self):
         """
         Creates a build in Persephone and saves the build id in self.build_id
@@ -87,20 +108,180 @@ class PersephoneBuildHelper:
         self.client.fail_build(self.project_id, self.build_id)
         self.build_id = None
 
-    def upload_screenshot(self, name, image_data, metadata=None):
+    def upload_screenshot(self, name, image_data=None, metadata=None, image_path=None,
+                          chunked=False):
         """
         Uploads a screenshot to the current build.
         :param name: A freeform name for the screenshot (e.g. subfolder/image.png).
-        :param image_data: A bytes object with a PNG screenshot.
+        :param image_data: A bytes object or a binary file-like object with a PNG screenshot.
         :param metadata: An optional freeform dict with JSON serializable values to attach to the
         image as metadata.
+        :param image_path: A path to a PNG screenshot to upload instead of image_data. The file is
+        opened and passed to the client, so it is never read into a bytes object by the caller.
+        :param chunked: Upload image_path in chunks that are retried individually. Useful for large
+        screenshots on unreliable networks. Requires image_path. (optional)
         """
         if not self.build_id:
             raise PersephoneException('No build is running. Please create a build first.')
-        screenshot = self.client.post_screenshot(
-            self.project_id, self.build_id, name, image_data, metadata)
+        if (image_data is None) == (image_path is None):
+            raise PersephoneException('Please specify exactly one of image_data and image_path.')
+        if chunked:
+            if image_path is None:
+                raise PersephoneException('Chunked uploads require image_path.')
+            screenshot = self.client.post_screenshot_chunked(
+                self.project_id, self.build_id, name, image_path, metadata=metadata)
+            return screenshot['id']
+        screenshot = self.client.post_screenshot_to_url(
+            self._screenshots_url,
+            name,
+            image_data if image_data is not None else pathlib.Path(image_path),
+            metadata,
+        )
         return screenshot['id']
 
+    async def upload_screenshots_async(self, items, concurrency=DEFAULT_UPLOAD_CONCURRENCY):
+        """
+        Uploads multiple screenshots to the current build concurrently. Requires aiohttp, or
+        httpx[http2] if the helper was created with http2=True.
+        :param items: An iterable of (name, image_data, metadata) tuples, with the same meaning as
+        the arguments of upload_screenshot. image_data may also be a path to a PNG file. Uploads
+        failing with a 5xx are retried, except for file-like objects when using aiohttp.
+        :param concurrency: The maximum number of uploads in flight at the same time.
+        :return: A list with the IDs of the uploaded screenshots, in the order of items.
+        """
+        if not self.build_id:
+            raise PersephoneException('No build is running. Please create a build first.')
+        try:
+            if self.client.http2:
+                return await self._upload_screenshots_http2(items, concurrency)
+            return await self._upload_screenshots_aiohttp(items, concurrency)
+        finally:
+            # The uploads bypass self.client, so its cached GETs have to be dropped here
+            self.client.clear_cache()
+
+    async def _upload_screenshots_aiohttp(self, items, concurrency):
+        import aiohttp
+
+        url = self._screenshots_url
+        async with aiohttp.ClientSession(
+                headers=dict(self.client._auth_header, **ACCEPT_JSON_HEADERS),
+                connector=aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency),
+                # Like requests and httpx, limit connecting and reading, not the whole upload
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.client.timeout, sock_read=self.client.timeout),
+        ) as session:
+            async def post(name, image_data, metadata, last_attempt):
+                if hasattr(image_data, 'read'):
+                    # aiohttp closes streams after sending them, so they can't be sent again
+                    last_attempt = True
+                with _open_image(image_data) as image:
+                    filename, content_type = 'image', None
+                    if isinstance(image, tuple):
+                        filename, image, content_type = image
+                    form = aiohttp.FormData()
+                    form.add_field('name', name)
+                    form.add_field('metadata', _dumps(metadata))
+                    form.add_field('image', image, filename=filename, content_type=content_type)
+                    async with session.post(url, data=form) as resp:
+                        if resp.status >= 500 and not last_attempt:
+                            return None
+                        resp.raise_for_status()
+                        screenshot = _loads(await resp.read())
+                        return screenshot['id']
+
+            return await self._gather_uploads(post, items, concurrency)
+
+    async def _upload_screenshots_http2(self, items, concurrency):
+        import httpx
+
+        async with AsyncPersephoneClient(
+                self.client.root_endpoint,
+                self.client.username,
+                self.client.password,
+                self.client.timeout,
+                max_connections=concurrency,
+        ) as client:
+            async def post(name, image_data, metadata, last_attempt):
+                try:
+                    screenshot = await client.post_screenshot(
+                        self.project_id, self.build_id, name, image_data, metadata)
+                except httpx.HTTPStatusError as e:
+                    if e.response.status_code >= 500 and not last_attempt:
+                        return None
+                    raise
+                return screenshot['id']
+
+            return await self._gather_uploads(post, items, concurrency)
+
+    @staticmethod
+    async def _gather_uploads(post, items, concurrency):
+        """
+        Runs post(name, image_data, metadata, last_attempt) for all items, at most concurrency at a
+        time. post returns None to request a retry, which happens with exponential backoff.
+        """
+        import asyncio
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def upload(name, image_data, metadata):
+            async with semaphore:
+                for attempt in range(UPLOAD_MAX_RETRIES + 1):
+                    screenshot_id = await post(
+                        name, image_data, metadata, attempt == UPLOAD_MAX_RETRIES)
+                    if screenshot_id is not None:
+                        return screenshot_id
+                    await asyncio.sleep(2 ** attempt + random.random())
+
+        results = await asyncio.gather(
+            *(upload(name, image_data, metadata) for name, image_data, metadata in items),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def upload_screenshots(self, items, concurrency=DEFAULT_UPLOAD_CONCURRENCY):
+        """
+        Synchronous wrapper around upload_screenshots_async. Falls back to
+        upload_screenshots_threaded if the async HTTP library is not installed.
+        """
+        import asyncio
+
+        try:
+            if self.client.http2:
+                import httpx  # noqa: F401
+            else:
+                import aiohttp  # noqa: F401
+        except ImportError:
+            return self.upload_screenshots_threaded(items, concurrency)
+        return asyncio.run(self.upload_screenshots_async(items, concurrency))
+
+    def upload_screenshots_threaded(self, items, max_workers=DEFAULT_UPLOAD_CONCURRENCY):
+        """
+        Uploads multiple screenshots to the current build from a thread pool. Unlike
+        upload_screenshots_async this needs no extra dependencies and works from code that already
+        runs an event loop, at the cost of one thread per concurrent upload.
+        :param items: An iterable of (name, image_data, metadata) tuples, with the same meaning as
+        the arguments of upload_screenshot. image_data may also be a path to a PNG file.
+        :param max_workers: The maximum number of uploads in flight at the same time. Capped to the
+        client's connection pool size, as extra threads would only wait for a connection.
+        :return: A list with the IDs of the uploaded screenshots, in the order of items.
+        """
+        from concurrent import futures
+
+        if not self.build_id:
+            raise PersephoneException('No build is running. Please create a build first.')
+        with futures.ThreadPoolExecutor(min(max_workers, POOL_MAXSIZE)) as executor:
+            indices = {
+                executor.submit(self.upload_screenshot, name, image_data, metadata): i
+                for i, (name, image_data, metadata) in enumerate(items)
+            }
+            results = [None] * len(indices)
+            for future in futures.as_completed(indices):
+                results[indices[future]] = future.result()
+        return results
+
 
 class JenkinsBuildHelper(PersephoneBuildHelper):
     def __init__(self, *args, **kwargs):
@@ -1,134 +1,524 @@
+import base64
+import collections
+import contextlib
+import gzip
 import json
-from urllib import parse
+import os
+import pathlib
+import random
+import time
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps_bytes(obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # Anything orjson rejects that json accepts, e.g. integers wider than 64 bits
+            return json.dumps(obj).encode()
+
+    def _dumps(obj):
+        return _dumps_bytes(obj).decode()
+except ImportError:
+    _dumps = json.dumps
+    _loads = json.loads
+
+    def _dumps_bytes(obj):
+        return json.dumps(obj).encode()
 
-import requests
 
 DEFAULT_TIMEOUT = 12.05
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 20
+MAX_RETRIES = 5
+RETRY_STATUSES = (502, 503, 504)
+ACCEPT_JSON_HEADERS = {'Accept': 'application/json'}
+JSON_HEADERS = {'Content-Type': 'application/json'}
+GZIP_JSON_HEADERS = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+GZIP_MIN_SIZE = 1024
+GET_CACHE_TTL = 30
+GET_CACHE_BUILD_TTL = 5
+GET_CACHE_MAX_SIZE = 256
+DEFAULT_CHUNK_SIZE = 2 * 1024 * 1024
+CHUNK_MAX_RETRIES = 3
+
+
+def _parse(resp):
+    # Persephone always responds with UTF-8 JSON, so skip the charset detection of resp.json()
+    return _loads(resp.content)
+
+
+@contextlib.contextmanager
+def _open_image(image_data):
+    """
+    Yields the value for the multipart image field. Paths are opened and given as a
+    (file name, file, content type) tuple, anything else is passed through unchanged.
+    """
+    if isinstance(image_data, (str, pathlib.Path)):
+        path = pathlib.Path(image_data)
+        with path.open('rb') as f:
+            yield path.name, f, 'image/png'
+    else:
+        yield image_data
 
 
 class PersephoneException(Exception):
     pass
 
 
-class PersephoneClient:
-    """A lower level client for the Persephone REST API"""
+# Precomputed endpoint URLs, all of which end with a slash except the build actions
+_Endpoints = collections.namedtuple('_Endpoints', 'api projects')
+_ProjectEndpoints = collections.namedtuple('_ProjectEndpoints', 'project builds')
+_BuildEndpoints = collections.namedtuple('_BuildEndpoints', 'build screenshots finish fail')
+
+
+class _HeaderAuth:
+    """Sets a precomputed Authorization header instead of encoding the credentials per request"""
+
+    def __init__(self, header):
+        self.header = header
+
+    def __call__(self, r):
+        r.headers['Authorization'] = self.header
+        return r
+
+
+class BasePersephoneClient:
+    """Connection settings and endpoint construction shared by the sync and async clients"""
 
     def __init__(self, root_endpoint, username, password, timeout=DEFAULT_TIMEOUT):
-        self.root_endpoint = root_endpoint
+        # Endpoints below are built by plain concatenation, which relies on the trailing slash
+        self.root_endpoint = root_endpoint if root_endpoint.endswith('/') else root_endpoint + '/'
         self.username = username
         self.password = password
-        self.timeout = DEFAULT_TIMEOUT
+        self.timeout = timeout
         self._auth = (username, password)
+        token = base64.b64encode('{}:{}'.format(username, password).encode()).decode()
+        self._auth_header = {'Authorization': 'Basic {}'.format(token)}
+        self._endpoints = _Endpoints(
+            api=self.root_endpoint + 'api/v1/',
+            projects=self.root_endpoint + 'api/v1/projects/',
+        )
+        # Lazily built, keyed by project_id and (project_id, build_id) respectively
+        self._project_endpoints = {}
+        self._build_endpoints = {}
+
+    def _project(self, project_id):
+        endpoints = self._project_endpoints.get(project_id)
+        if endpoints is None:
+            project = '{}{}/'.format(self._endpoints.projects, project_id)
+            endpoints = _ProjectEndpoints(project=project, builds=project + 'builds/')
+            self._project_endpoints[project_id] = endpoints
+        return endpoints
+
+    def _build(self, project_id, build_id):
+        key = (project_id, build_id)
+        endpoints = self._build_endpoints.get(key)
+        if endpoints is None:
+            build = '{}{}/'.format(self._project(project_id).builds, build_id)
+            endpoints = _BuildEndpoints(
+                build=build,
+                screenshots=build + 'screenshots/',
+                finish=build + 'finish',
+                fail=build + 'fail',
+            )
+            self._build_endpoints[key] = endpoints
+        return endpoints
 
     def _get_api_endpoint(self):
-        return parse.urljoin(self.root_endpoint, 'api/v1/')
+        return self._endpoints.api
 
     def _get_projects_endpoint(self):
-        return parse.urljoin(self._get_api_endpoint(), 'projects/')
+        return self._endpoints.projects
 
     def _get_project_endpoint(self, project_id):
-        return parse.urljoin(self._get_projects_endpoint(), '{}/'.format(project_id))
+        return self._project(project_id).project
 
     def _get_builds_endpoint(self, project_id):
-        return parse.urljoin(self._get_project_endpoint(project_id), 'builds/')
+        return self._project(project_id).builds
 
     def _get_build_endpoint(self, project_id, build_id):
-        return parse.urljoin(self._get_builds_endpoint(project_id), '{}/'.format(build_id))
+        return self._build(project_id, build_id).build
 
     def _get_screenshots_endpoint(self, project_id, build_id):
-        return parse.urljoin(self._get_build_endpoint(project_id, build_id), 'screenshots/')
+        return self._build(project_id, build_id).screenshots
 
-    def get_projects(self):
-        resp = requests.get(
-            self._get_projects_endpoint(),
-            auth=self._auth,
-            timeout=self.timeout,
+
+class PersephoneClient(BasePersephoneClient):
+    """A lower level client for the Persephone REST API"""
+
+    def __init__(self, root_endpoint, username, password, timeout=DEFAULT_TIMEOUT,
+                 cache_ttl=GET_CACHE_TTL, http2=False):
+        """
+        :param cache_ttl: For how many seconds responses of get_projects, get_project and
+        get_builds are reused (get_build at most 5 seconds). 0 disables caching.
+        :param http2: Use httpx with HTTP/2 instead of requests, so that concurrent requests are
+        multiplexed over a single connection. Requires httpx[http2]. Note that HTTP errors are then
+        raised as httpx.HTTPStatusError instead of requests.HTTPError.
+        """
+        super().__init__(root_endpoint, username, password, timeout)
+        self.http2 = http2
+        self._session = self._create_http2_session() if http2 else self._create_session()
+        # httpx takes a raw body as content=, while requests takes it as data=
+        self._raw_body_kwarg = 'content' if http2 else 'data'
+        # Responses of read-only endpoints, url -> (time fetched, raw JSON body), in LRU order
+        self.cache_ttl = cache_ttl
+        self._get_cache = collections.OrderedDict()
+        # Whether the server accepts gzip request bodies, None until probed
+        self._accepts_gzip = None
+        # Session without transport level retries for chunk uploads, created on first use
+        self._chunk_session = None
+
+    def _create_http2_session(self, retry=True, auth=True):
+        import httpx
+
+        self._transport_errors = (httpx.TransportError,)
+        # httpx only retries failed connection attempts, status based retries are requests only
+        return httpx.Client(
+            auth=self._auth if auth else None,
+            headers=ACCEPT_JSON_HEADERS,
+            transport=httpx.HTTPTransport(
+                http2=True,
+                retries=MAX_RETRIES if retry else 0,
+                limits=httpx.Limits(
+                    max_connections=POOL_CONNECTIONS,
+                    max_keepalive_connections=POOL_CONNECTIONS,
+                ),
+            ),
         )
-        resp.raise_for_status()
-        return resp.json()
 
-    def get_project(self, project_id):
-        resp = requests.get(
-            self._get_project_endpoint(project_id),
-            auth=self._auth,
-            timeout=self.timeout,
+    def _create_session(self, retry=True, auth=True):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self._transport_errors = (requests.ConnectionError, requests.Timeout)
+        session = requests.Session()
+        if auth:
+            # An auth object rather than a default header, so that requests doesn't look up .netrc
+            session.auth = _HeaderAuth(self._auth_header['Authorization'])
+        session.headers.update(ACCEPT_JSON_HEADERS)
+        adapter = HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS,
+            pool_maxsize=POOL_MAXSIZE,
+            max_retries=self._create_retry(Retry) if retry else 0,
         )
-        resp.raise_for_status()
-        return resp.json()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
 
-    def get_builds(self, project_id):
-        resp = requests.get(
-            self._get_builds_endpoint(project_id),
-            auth=self._auth,
+    @staticmethod
+    def _create_retry(retry_class):
+        """
+        Retries connection errors, read errors and gateway errors with exponential backoff. POST is
+        retried too: Persephone deduplicates builds by commit hash and screenshots by image hash,
+        so a repeated create_build or post_screenshot doesn't create duplicates. Once retries are
+        exhausted the last response is returned, so callers still get a regular HTTPError.
+        """
+        kwargs = dict(
+            total=MAX_RETRIES,
+            connect=3,
+            read=3,
+            status=3,
+            backoff_factor=0.3,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS']),
+            raise_on_status=False,
+        )
+        import urllib3
+
+        # backoff_jitter was added in urllib3 2.0
+        if int(urllib3.__version__.split('.')[0]) >= 2:
+            kwargs['backoff_jitter'] = 0.5
+        return retry_class(**kwargs)
+
+    def close(self):
+        """Closes the underlying HTTP session and releases any pooled connections."""
+        self._session.close()
+        if self._chunk_session is not None:
+            self._chunk_session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _cached_get(self, url, ttl):
+        """
+        GETs url, reusing a previous response if it is less than ttl seconds old. The raw body is
+        cached and parsed on every call, so callers are free to modify the returned object.
+        """
+        now = time.monotonic()
+        cached = self._get_cache.get(url)
+        if cached is not None and now - cached[0] < ttl:
+            try:
+                self._get_cache.move_to_end(url)
+            except KeyError:
+                pass  # Invalidated concurrently, the response is still good to return
+            return _loads(cached[1])
+        resp = self._session.get(
+            url,
             timeout=self.timeout,
         )
         resp.raise_for_status()
-        return resp.json()
+        if ttl > 0:
+            self._get_cache.pop(url, None)
+            self._get_cache[url] = (now, resp.content)
+            if len(self._get_cache) > GET_CACHE_MAX_SIZE:
+                self._get_cache.popitem(last=False)
+        return _parse(resp)
+
+    def clear_cache(self):
+        """Discards all cached GET responses."""
+        self._get_cache.clear()
+
+    def get_projects(self):
+        return self._cached_get(self._endpoints.projects, self.cache_ttl)
+
+    def get_project(self, project_id):
+        return self._cached_get(self._project(project_id).project, self.cache_ttl)
+
+    def get_builds(self, project_id):
+        return self._cached_get(self._project(project_id).builds, self.cache_ttl)
 
     def get_build(self, project_id, build_id):
-        resp = requests.get(
-            self._get_build_endpoint(project_id, build_id),
-            auth=self._auth,
+        # The build status changes while it is running, so it is only cached briefly
+        return self._cached_get(
+            self._build(project_id, build_id).build,
+            min(self.cache_ttl, GET_CACHE_BUILD_TTL),
+        )
+
+    def _server_accepts_gzip(self):
+        """
+        Checks once whether the server advertises gzip support for request bodies, through the
+        Accept-Encoding header of an OPTIONS response (RFC 7694).
+        """
+        if self._accepts_gzip is None:
+            try:
+                resp = self._session.options(self._endpoints.api, timeout=self.timeout)
+                accept_encoding = resp.headers.get('Accept-Encoding', '')
+            except self._transport_errors:
+                accept_encoding = ''
+            self._accepts_gzip = 'gzip' in accept_encoding.lower()
+        return self._accepts_gzip
+
+    def _post_json(self, url, payload):
+        body = _dumps_bytes(payload)
+        headers = JSON_HEADERS
+        if len(body) > GZIP_MIN_SIZE and self._server_accepts_gzip():
+            body = gzip.compress(body)
+            headers = GZIP_JSON_HEADERS
+        return self._session.post(
+            url,
+            headers=headers,
             timeout=self.timeout,
+            **{self._raw_body_kwarg: body},
         )
-        resp.raise_for_status()
-        return resp.json()
 
     def create_build(self, project_id, commit_hash=None, branch_name=None,
                      original_build_number=None, original_build_url=None, pull_request_id=None):
-        resp = requests.post(
-            self._get_builds_endpoint(project_id),
-            auth=self._auth,
-            json={
+        resp = self._post_json(
+            self._project(project_id).builds,
+            {
                 'commit_hash': commit_hash,
                 'branch_name': branch_name,
                 'original_build_number': original_build_number,
                 'original_build_url': original_build_url,
                 'pull_request_id': pull_request_id,
             },
-            timeout=self.timeout,
         )
+        self.clear_cache()
         resp.raise_for_status()
-        return resp.json()
+        return _parse(resp)
 
     def delete_build(self, project_id, build_id):
-        resp = requests.delete(
-            self._get_build_endpoint(project_id, build_id),
-            auth=self._auth,
+        resp = self._session.delete(
+            self._build(project_id, build_id).build,
             timeout=self.timeout,
         )
+        self.clear_cache()
         resp.raise_for_status()
 
     def finish_build(self, project_id, build_id):
-        resp = requests.post(
-            parse.urljoin(self._get_build_endpoint(project_id, build_id), 'finish'),
-            auth=self._auth,
+        resp = self._session.post(
+            self._build(project_id, build_id).finish,
             timeout=self.timeout,
         )
+        self.clear_cache()
         resp.raise_for_status()
-        return resp.json()
+        return _parse(resp)
 
     def fail_build(self, project_id, build_id):
-        resp = requests.post(
-            parse.urljoin(self._get_build_endpoint(project_id, build_id), 'fail'),
-            auth=self._auth,
+        resp = self._session.post(
+            self._build(project_id, build_id).fail,
             timeout=self.timeout,
         )
+        self.clear_cache()
         resp.raise_for_status()
-        return resp.json()
+        return _parse(resp)
 
     def post_screenshot(self, project_id, build_id, name, image_data, metadata):
-        resp = requests.post(
-            self._get_screenshots_endpoint(project_id, build_id),
+        """
+        Uploads a screenshot to a build.
+        :param image_data: The PNG screenshot as a bytes object, a binary file-like object or a
+        path (str or pathlib.Path) to a PNG file. Files are handed to requests directly, so the
+        caller never needs to read them into memory.
+        """
+        return self.post_screenshot_to_url(
+            self._build(project_id, build_id).screenshots, name, image_data, metadata)
+
+    def post_screenshot_to_url(self, url, name, image_data, metadata):
+        """
+        Same as post_screenshot, but takes the screenshots endpoint of the build directly, for
+        callers that upload many screenshots to the same build.
+        """
+        with _open_image(image_data) as image:
+            return self._post_screenshot(url, name, image, metadata)
+
+    def _post_screenshot(self, url, name, image, metadata):
+        resp = self._session.post(
+            url,
+            data={
+                'name': name,
+                'metadata': _dumps(metadata),
+            },
+            files={
+                'image': image,
+            },
+            timeout=self.timeout,
+        )
+        self.clear_cache()
+        resp.raise_for_status()
+        return _parse(resp)
+
+    def post_screenshot_chunked(self, project_id, build_id, name, path,
+                                chunk_size=DEFAULT_CHUNK_SIZE, metadata=None):
+        """
+        Uploads a screenshot from a file in chunks, so that a dropped connection only retries the
+        current chunk instead of the whole file. Falls back to post_screenshot if the server
+        doesn't support chunked uploads.
+        :param path: A path (str or pathlib.Path) to a PNG file.
+        :param chunk_size: The size of each uploaded chunk in bytes.
+        """
+        screenshots_endpoint = self._build(project_id, build_id).screenshots
+        size = os.path.getsize(path)
+        resp = self._post_json(screenshots_endpoint + 'init', {
+            'name': name,
+            'size': size,
+            'chunk_size': chunk_size,
+        })
+        if resp.status_code == 404:
+            return self.post_screenshot(project_id, build_id, name, pathlib.Path(path), metadata)
+        resp.raise_for_status()
+        upload = _parse(resp)
+        offsets = range(0, size, chunk_size)
+        if len(upload['chunk_urls']) != len(offsets):
+            raise PersephoneException('Expected {} chunk URLs from the server, got {}.'.format(
+                len(offsets), len(upload['chunk_urls'])))
+
+        with open(path, 'rb') as f:
+            for offset, chunk_url in zip(offsets, upload['chunk_urls']):
+                f.seek(offset)
+                chunk = f.read(chunk_size)
+                self._put_chunk(chunk_url, chunk, {
+                    'Content-Range': 'bytes {}-{}/{}'.format(
+                        offset, offset + len(chunk) - 1, size),
+                })
+
+        resp = self._post_json(
+            '{}{}/complete'.format(screenshots_endpoint, upload['upload_id']),
+            {'metadata': metadata},
+        )
+        self.clear_cache()
+        resp.raise_for_status()
+        return _parse(resp)
+
+    def _put_chunk(self, url, chunk, headers):
+        """
+        PUTs a single chunk, retrying connection errors and 5xx with exponential backoff. Uses a
+        session without transport retries, so that this is the only retry loop for chunks.
+        Credentials are only sent if the chunk URL is on the Persephone server, since the server
+        may hand out URLs on another host, e.g. presigned storage URLs.
+        """
+        if self._chunk_session is None:
+            self._chunk_session = (
+                self._create_http2_session(retry=False, auth=False) if self.http2
+                else self._create_session(retry=False, auth=False))
+        if url.startswith(self.root_endpoint):
+            headers = dict(headers, **self._auth_header)
+        for attempt in range(CHUNK_MAX_RETRIES + 1):
+            last_attempt = attempt == CHUNK_MAX_RETRIES
+            try:
+                resp = self._chunk_session.put(
+                    url,
+                    headers=headers,
+                    timeout=self.timeout,
+                    **{self._raw_body_kwarg: chunk},
+                )
+            except self._transport_errors:
+                if last_attempt:
+                    raise
+            else:
+                if resp.status_code < 500 or last_attempt:
+                    resp.raise_for_status()
+                    return
+            time.sleep(2 ** attempt + random.random())
+
+
+class AsyncPersephoneClient(BasePersephoneClient):
+    """
+    An asyncio client for uploading screenshots, using httpx with HTTP/2 so that concurrent
+    uploads share a single connection. Requires httpx[http2].
+    """
+
+    def __init__(self, root_endpoint, username, password, timeout=DEFAULT_TIMEOUT,
+                 max_connections=POOL_CONNECTIONS):
+        import httpx
+
+        super().__init__(root_endpoint, username, password, timeout)
+        self._session = httpx.AsyncClient(
+            http2=True,
             auth=self._auth,
+            headers=ACCEPT_JSON_HEADERS,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+
+    async def close(self):
+        """Closes the underlying HTTP client and releases any pooled connections."""
+        await self._session.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def post_screenshot(self, project_id, build_id, name, image_data, metadata):
+        """
+        Uploads a screenshot to a build. Accepts the same image_data as
+        PersephoneClient.post_screenshot.
+        """
+        with _open_image(image_data) as image:
+            return await self._post_screenshot(project_id, build_id, name, image, metadata)
+
+    async def _post_screenshot(self, project_id, build_id, name, image, metadata):
+        resp = await self._session.post(
+            self._build(project_id, build_id).screenshots,
             data={
                 'name': name,
-                'metadata': json.dumps(metadata),
+                'metadata': _dumps(metadata),
             },
             files={
-                'image': image_data,
+                'image': image,
             },
             timeout=self.timeout,
         )
         resp.raise_for_status()
-        return resp.json()
+        return _parse(resp)
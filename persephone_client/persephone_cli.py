@@ -114,8 +114,6 @@ def main():
         if not build_id or not image_name or not image_path:
             print('ERROR: Please specify a build id, image name and image path.')
             sys.exit(1)
-        with open(image_path, 'rb') as f:
-            data = f.read()
         try:
             metadata = json.loads(image_metadata)
         except json.JSONDecodeError:
@@ -123,8 +121,8 @@ def main():
             sys.exit(1)
         screenshot_id = client.upload_screenshot(
             image_name,
-            data,
-            metadata,
+            metadata=metadata,
+            image_path=image_path,
         )
         print(screenshot_id)
 
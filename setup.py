@@ -28,7 +28,13 @@ setup(
     packages=['persephone_client'],
     install_requires=[
         'requests',
+        'urllib3>=1.26',
     ],
+    extras_require={
+        'async': ['aiohttp'],
+        'fast': ['orjson'],
+        'http2': ['httpx[http2]'],
+    },
     zip_safe=False,
     entry_points={
         'console_scripts': [